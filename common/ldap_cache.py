@@ -0,0 +1,96 @@
+"""
+Local SQLite snapshot of the users in the UFZ LDAP directory
+
+the first sync reads all users, later syncs only fetch entries with a
+modifyTimestamp newer than the last sync and remove users whose dn is
+not in the directory anymore (checked with a search that returns no
+attributes)
+"""
+
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict
+
+from ldap3 import Connection
+
+from ldap_users import iter_ldap_users, PERSON_FILTER
+
+# request no attributes, see RFC 4511 section 4.5.1.8
+NO_ATTRIBUTES = "1.1"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    dn TEXT PRIMARY KEY,
+    uid TEXT,
+    cn TEXT,
+    mail TEXT,
+    modified TEXT
+);
+CREATE TABLE IF NOT EXISTS sync (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _generalized_time(value) -> str:
+    """
+    modifyTimestamp as generalized time string (YYYYmmddHHMMSSZ)
+    independent of ldap3 returning it as datetime (schema known) or str
+    """
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime("%Y%m%d%H%M%SZ")
+    return f"{str(value)[:14]}Z"
+
+
+def sync_ldap_users(connection: Connection, path: str, full: bool = False) -> Dict[str, dict]:
+    """
+    update the snapshot in path and return a mapping from uid to cn and mail
+    """
+    db = sqlite3.connect(path)
+    with db:
+        db.executescript(SCHEMA)
+        if full:
+            db.execute("DELETE FROM users")
+            db.execute("DELETE FROM sync")
+        row = db.execute("SELECT value FROM sync WHERE key = 'modified'").fetchone()
+        last_modified = row[0] if row else None
+
+        if last_modified:
+            search_filter = f"(&{PERSON_FILTER}(modifyTimestamp>={last_modified}))"
+        else:
+            search_filter = PERSON_FILTER
+        for user in iter_ldap_users(
+            connection,
+            ["uid", "cn", "mail", "modifyTimestamp"],
+            search_filter=search_filter,
+        ):
+            modified = user["modifyTimestamp"]
+            modified = _generalized_time(modified) if modified else None
+            db.execute(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)",
+                (user["dn"], user["uid"], user["cn"], user["mail"], modified),
+            )
+            if modified and (not last_modified or modified > last_modified):
+                last_modified = modified
+
+        # removed users: only the dns are transferred
+        if row:
+            present = set(
+                user["dn"] for user in iter_ldap_users(connection, [NO_ATTRIBUTES])
+            )
+            cached = set(dn for (dn,) in db.execute("SELECT dn FROM users"))
+            db.executemany(
+                "DELETE FROM users WHERE dn = ?", [(dn,) for dn in cached - present]
+            )
+
+        if last_modified:
+            db.execute(
+                "INSERT OR REPLACE INTO sync VALUES ('modified', ?)", (last_modified,)
+            )
+        users = {
+            uid: {"cn": cn, "mail": mail}
+            for uid, cn, mail in db.execute("SELECT uid, cn, mail FROM users")
+        }
+    db.close()
+    return users
@@ -0,0 +1,49 @@
+"""
+Streaming access to the users in the UFZ LDAP directory
+
+the directory is read with the simple paged results control and only
+the requested attributes of person entries are transferred, entries are
+yielded one by one instead of being collected in Connection.entries
+"""
+
+from typing import Dict, Iterator, List, Optional
+
+from ldap3 import Connection, SUBTREE
+
+BASE_DN = "ou=people,dc=ufz,dc=de"
+PERSON_FILTER = "(objectClass=person)"
+PAGE_SIZE = 1000
+
+
+def _single(value):
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def iter_ldap_users(
+    connection: Connection,
+    attributes: List[str],
+    base_dn: str = BASE_DN,
+    search_filter: str = PERSON_FILTER,
+    page_size: int = PAGE_SIZE,
+) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    yield a dict with the given attributes (and the dn) for each user
+
+    multi valued attributes are reduced to their first value,
+    missing attributes are None
+    """
+    for entry in connection.extend.standard.paged_search(
+        base_dn,
+        search_filter,
+        search_scope=SUBTREE,
+        attributes=attributes,
+        paged_size=page_size,
+        generator=True,
+    ):
+        if entry.get("type") != "searchResEntry":
+            continue
+        user = {a: _single(entry["attributes"].get(a)) for a in attributes}
+        user["dn"] = entry["dn"]
+        yield user
@@ -0,0 +1,89 @@
+"""
+Helpers for resumable, rate limited bulk operations
+
+- RateLimiter spaces calls (from any number of threads) evenly
+- Checkpoint records the ids of completed operations (optionally with the
+  kind of operation) in a file such that an interrupted run can skip them
+"""
+
+import os.path
+import threading
+import time
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    allow at most rate calls per second, no limit if rate is 0 or None
+    """
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        block until the next call is allowed
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Checkpoint:
+    """
+    completed ids that are persisted (one id per line) in path
+
+    an id can be recorded with a state (e.g. the operation that was done),
+    stored as id<TAB>state. with readonly the file is only read (e.g. for
+    dry runs), added ids are not stored
+    """
+
+    def __init__(self, path: Optional[str], readonly: bool = False):
+        self.path = path
+        self.done = {}
+        self._fh = None
+        if not path:
+            return
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    fields = line.strip().split("\t")
+                    if fields[0]:
+                        self.done[fields[0]] = fields[1] if len(fields) > 1 else None
+        if readonly:
+            return
+        self._fh = open(path, "a")
+        self._lock = threading.Lock()
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.done
+
+    def state(self, item_id: str) -> Optional[str]:
+        """
+        state recorded for item_id (None if there is none)
+        """
+        return self.done.get(item_id)
+
+    def add(self, item_id: str, state: Optional[str] = None):
+        """
+        mark item_id as completed
+        """
+        self.done[item_id] = state
+        if self._fh is None:
+            return
+        line = item_id if state is None else f"{item_id}\t{state}"
+        with self._lock:
+            self._fh.write(f"{line}\n")
+            self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
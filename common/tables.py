@@ -0,0 +1,29 @@
+"""
+Writing of result tables as csv or parquet
+"""
+
+import csv
+import sys
+from typing import Dict
+
+# optional, for parquet output
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+
+def write_table(path: str, columns: Dict[str, list]):
+    """
+    write columns as csv or, if path ends with .parquet, as parquet
+    (requires pandas and pyarrow)
+    """
+    if path.endswith(".parquet"):
+        if pandas is None:
+            sys.exit("pandas is needed for writing parquet tables")
+        pandas.DataFrame(columns).to_parquet(path, index=False)
+        return
+    with open(path, "w", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(columns)
+        writer.writerows(zip(*columns.values()))
@@ -0,0 +1,131 @@
+r"""
+Include / exclude filter for tool ids
+
+all patterns of a filter are compiled once:
+- anchored literal patterns (e.g. ^toolshed\.g2\.bx\.psu\.edu/repos/iuc/)
+  are stored in a prefix trie
+- all other patterns are joined in a single regular expression, except
+  patterns with groups (backreferences would be renumbered) or global
+  flags, which are compiled separately
+patterns can also be read from files (one pattern per line, # comments)
+"""
+
+import re
+from typing import Iterable, List, Optional
+
+REGEX_META = set(".^$*+?{}[]\\|()")
+GLOBAL_FLAGS_RE = re.compile(r"\(\?[aiLmsux]+\)")
+
+
+def read_patterns(path: str) -> List[str]:
+    """
+    read patterns from a file, empty lines and lines starting with # are ignored
+    """
+    with open(path) as fh:
+        return [line.strip() for line in fh if line.strip() and not line.startswith("#")]
+
+
+def _literal(pattern: str) -> Optional[str]:
+    """
+    the string matched by pattern if it does not use regular expression
+    features (besides escaping), otherwise None
+    """
+    chars = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                chars.append(pattern[i + 1])
+                i += 2
+                continue
+            return None
+        if c in REGEX_META:
+            return None
+        chars.append(c)
+        i += 1
+    return "".join(chars)
+
+
+class PrefixTrie:
+    """
+    set of prefixes that allows to check if a string starts with any of them
+    in time proportional to the length of the string
+    """
+
+    END = ""
+
+    def __init__(self, prefixes: Iterable[str] = ()):
+        self.root = {}
+        self.size = 0
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix: str):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[self.END] = True
+        self.size += 1
+
+    def match(self, s: str) -> bool:
+        node = self.root
+        if self.END in node:
+            return True
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
+class PatternSet:
+    """
+    matches a string if any of the patterns is found (re.search semantics)
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.prefixes = PrefixTrie()
+        joined = []
+        self.regexes = []
+        for pattern in patterns:
+            literal = _literal(pattern[1:]) if pattern.startswith("^") else None
+            if literal is not None:
+                self.prefixes.add(literal)
+                continue
+            regex = re.compile(pattern)
+            if regex.groups or GLOBAL_FLAGS_RE.match(pattern):
+                self.regexes.append(regex)
+            else:
+                joined.append(pattern)
+        if joined:
+            try:
+                self.regexes.append(re.compile("|".join(f"(?:{p})" for p in joined)))
+            except re.error:
+                self.regexes.extend(re.compile(p) for p in joined)
+
+    def __len__(self) -> int:
+        return self.prefixes.size + len(self.regexes)
+
+    def search(self, s: str) -> bool:
+        if self.prefixes.match(s):
+            return True
+        return any(regex.search(s) for regex in self.regexes)
+
+
+class ToolFilter:
+    """
+    a tool id passes the filter if it matches any include pattern
+    (or there are none) and no exclude pattern
+    """
+
+    def __init__(self, include: Iterable[str] = (), exclude: Iterable[str] = ()):
+        self.include = PatternSet(include)
+        self.exclude = PatternSet(exclude)
+
+    def __call__(self, tool_id: str) -> bool:
+        if len(self.include) and not self.include.search(tool_id):
+            return False
+        return not self.exclude.search(tool_id)
@@ -8,8 +8,9 @@ import os
 import os.path
 
 from bioblend.galaxy import GalaxyInstance
-from bioblend.galaxy.container_resolution  import ContainerResolutionClient
-from bioblend.galaxy.tool_dependencies import ToolDependenciesClient
+
+from container_store import ContainerStore
+from toolbox_snapshot import ToolboxSnapshot
 
 parser = argparse.ArgumentParser(description="List / install containers")
 parser.add_argument(
@@ -24,6 +25,25 @@ parser.add_argument( '--conda_prefix',
                      required=False,
                      default=None, 
                      help='The directory containing Galaxy\'s conda envs. Needs to be specified if there are no conda envs left for galaxy tools' )
+parser.add_argument( '--container-index',
+                     type=str,
+                     action="store",
+                     default=None,
+                     help='file storing the index of the container directories between runs' )
+parser.add_argument( '--snapshot',
+                     type=str,
+                     action="store",
+                     default=None,
+                     help='file storing the toolbox summary and resolution, shared with the other container scripts' )
+parser.add_argument( '--snapshot-ttl',
+                     type=float,
+                     action="store",
+                     default=3600,
+                     help='maximum age of the snapshot in seconds, default=3600' )
+parser.add_argument( '--refresh',
+                     action="store_true",
+                     default=False,
+                     help='ignore the stored snapshot' )
 parser.add_argument( '-log',
                      '--loglevel',
                      choices=['debug', 'info', 'warning', 'error'],
@@ -43,13 +63,15 @@ logger.addHandler(handler)
 # Add a formatter to the handler (optional)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
+logging.getLogger("toolbox_snapshot").setLevel(args.loglevel.upper())
+logging.getLogger("toolbox_snapshot").addHandler(handler)
 
 key = os.environ.get('GALAXY_API_KEY', args.key)
 galaxy_instance = GalaxyInstance(url=args.url, key=key)
-tool_dependency_client = ToolDependenciesClient(galaxy_instance=galaxy_instance)
+snapshot = ToolboxSnapshot(galaxy_instance, args.snapshot, args.snapshot_ttl, args.refresh)
 
 # get mapping from conda envs to tools using it
-tb = tool_dependency_client.summarize_toolbox(index_by = "tools")
+tb = snapshot.summary()
 tool_stats = {}
 for t in tb:
     # status contains the conda dependencioes for the requirements can be 
@@ -86,16 +108,17 @@ for u in conda_dirs.difference(conda_envs):
 #     logger.info(f"\t{c}")
 
 # check if all tools using a conda env have an installed container
-container_resolution_client = ContainerResolutionClient(galaxy_instance = galaxy_instance)
-res = container_resolution_client.resolve_toolbox()
+container_store = ContainerStore(args.container_index)
+res = snapshot.resolution()
 for r in res:
     tool_id = r["tool_id"]
     container = r["status"].get("environment_path")
-    if not (container and os.path.exists(container)):
+    if not (container and container_store.exists(container)):
         container = None
     if tool_id not in tool_stats:
         tool_stats[tool_id] = {}
     tool_stats[tool_id]['container'] = container
+container_store.save()
 
 logger.info(f"Found {len(set([x['container'] for x in tool_stats.values() if 'container' in x and x['container']]))} containers")
 # TODO check if there are extra/unused containers envs
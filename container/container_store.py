@@ -0,0 +1,90 @@
+"""
+Index of the container cache directories
+
+instead of one os.path.exists per tool each directory containing
+containers is scanned once (os.scandir) and existence checks are
+answered from memory. the index can be stored in a file, in the
+next run only directories whose mtime changed are scanned again
+"""
+
+import json
+import os
+import os.path
+from typing import Dict, Optional
+
+
+class ContainerStore:
+    """
+    names, sizes and mtimes of the files in the container directories
+    """
+
+    def __init__(self, index_path: Optional[str] = None):
+        self.index_path = index_path
+        # directory -> {"mtime": mtime, "entries": {name: [size, mtime]}}
+        self.directories: Dict[str, dict] = {}
+        # directories loaded from the index file, validated on first use
+        self._stored: Dict[str, dict] = {}
+        if index_path and os.path.exists(index_path):
+            with open(index_path) as fh:
+                self._stored = json.load(fh)
+
+    def _directory(self, path: str) -> dict:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {"mtime": None, "entries": {}}
+        stored = self._stored.get(path)
+        if stored and stored["mtime"] == mtime:
+            return stored
+        entries = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries[entry.name] = [st.st_size, st.st_mtime]
+        return {"mtime": mtime, "entries": entries}
+
+    def _entry(self, container: str):
+        container = os.path.abspath(container)
+        path, name = os.path.split(container)
+        if path not in self.directories:
+            self.directories[path] = self._directory(path)
+        return self.directories[path]["entries"].get(name)
+
+    def exists(self, container: str) -> bool:
+        """
+        check if the container is in the cache
+        """
+        return self._entry(container) is not None
+
+    def size(self, container: str) -> Optional[int]:
+        """
+        size of the container, None if it is not in the cache
+        """
+        entry = self._entry(container)
+        return entry[0] if entry else None
+
+    def forget(self, container: str):
+        """
+        rescan the directory of the container on the next check
+        (e.g. after installing it)
+        """
+        path = os.path.dirname(os.path.abspath(container))
+        self.directories.pop(path, None)
+        self._stored.pop(path, None)
+
+    def save(self):
+        """
+        store the index (if an index file is configured)
+        """
+        if not self.index_path:
+            return
+        stored = dict(self._stored)
+        stored.update(
+            (path, d) for path, d in self.directories.items() if d["mtime"] is not None
+        )
+        with open(f"{self.index_path}.tmp", "w") as fh:
+            json.dump(stored, fh)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
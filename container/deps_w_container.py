@@ -9,8 +9,9 @@ import os.path
 import shutil
 
 from bioblend.galaxy import GalaxyInstance
-from bioblend.galaxy.container_resolution import ContainerResolutionClient
-from bioblend.galaxy.tool_dependencies import ToolDependenciesClient
+
+from container_store import ContainerStore
+from toolbox_snapshot import ToolboxSnapshot
 
 parser = argparse.ArgumentParser(description="List / install containers")
 parser.add_argument(
@@ -25,6 +26,33 @@ parser.add_argument(
     default=False,
     help="remove unused dependencies, default: just list",
 )
+parser.add_argument(
+    "--container-index",
+    type=str,
+    action="store",
+    default=None,
+    help="file storing the index of the container directories between runs",
+)
+parser.add_argument(
+    "--snapshot",
+    type=str,
+    action="store",
+    default=None,
+    help="file storing the toolbox summary and resolution, shared with the other container scripts",
+)
+parser.add_argument(
+    "--snapshot-ttl",
+    type=float,
+    action="store",
+    default=3600,
+    help="maximum age of the snapshot in seconds, default=3600",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    default=False,
+    help="ignore the stored snapshot",
+)
 parser.add_argument(
     '-log',
     '--loglevel',
@@ -46,13 +74,15 @@ logger.addHandler(handler)
 # Add a formatter to the handler (optional)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
+logging.getLogger("toolbox_snapshot").setLevel(args.loglevel.upper())
+logging.getLogger("toolbox_snapshot").addHandler(handler)
 
 key = os.environ.get('GALAXY_API_KEY', args.key)
 galaxy_instance = GalaxyInstance(url=args.url, key=key)
-tool_dependency_client = ToolDependenciesClient(galaxy_instance=galaxy_instance)
+snapshot = ToolboxSnapshot(galaxy_instance, args.snapshot, args.snapshot_ttl, args.refresh)
 
 # get mapping from conda envs to tools using it
-tb = tool_dependency_client.summarize_toolbox(index_by="tools")
+tb = snapshot.summary()
 condaenv2tools = {}
 for t in tb:
     # status contains the conda dependencioes for the requirements can be 
@@ -74,7 +104,10 @@ for t in tb:
 logger.info(f"Found {len(condaenv2tools)} conda environments")
 
 # check if all tools using a conda env have a installed container
-container_resolution_client = ContainerResolutionClient(galaxy_instance=galaxy_instance)
+# the containers of all tools are resolved in a single request
+containers = {r["tool_id"]: r["status"].get("environment_path") for r in snapshot.resolution()}
+container_store = ContainerStore(args.container_index)
+removed = False
 for condaenv in condaenv2tools:
     condaenv_base = os.path.basename(condaenv)
     if condaenv.endswith("/_galaxy_"):
@@ -82,13 +115,11 @@ for condaenv in condaenv2tools:
     tools = condaenv2tools[condaenv]
     has_container = 0
     for tool in tools:
-        res = container_resolution_client.resolve_toolbox(tool_ids=[tool])
-        for i, r in enumerate(res):
-            container = r["status"].get("environment_path")
-            if container and os.path.exists(container):
-                has_container += 1
-            else:
-                logger.debug(f"{condaenv_base} no container for tool {tool}")
+        container = containers.get(tool)
+        if container and container_store.exists(container):
+            has_container += 1
+        else:
+            logger.debug(f"{condaenv_base} no container for tool {tool}")
     logger.debug(f"{condaenv_base} -> {has_container == len(tools)} (coverage {has_container}/{len(tools)})")
     if has_container == len(tools):
         if args.remove:
@@ -98,5 +129,10 @@ for condaenv in condaenv2tools:
             except Exception as e:
                 logger.error(f"could not remove {condaenv}: {e}")
             print(f"removed {condaenv}")
+            removed = True
         else:
             print(f"would remove {condaenv}")
+container_store.save()
+# the summary still lists the removed environments
+if removed:
+    snapshot.invalidate("summary")
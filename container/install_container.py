@@ -9,8 +9,8 @@ import argparse
 import logging
 import os
 import os.path
-import re
-from typing import List
+import sys
+import time
 
 from bioblend.galaxy import GalaxyInstance
 from bioblend.galaxy.tools import ToolClient
@@ -18,12 +18,19 @@ from bioblend.galaxy.container_resolution  import ContainerResolutionClient
 from galaxy.tool_util.version import parse_version
 from galaxy.util.tool_version import remove_version_from_guid
 
+from container_store import ContainerStore
+from scheduler import install_containers
+from toolbox_snapshot import ToolboxSnapshot
 
-def get_tool_list(galaxy_instance: GalaxyInstance, include: List[str], exclude: List[str], latest: bool):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from tool_filter import read_patterns, ToolFilter  # noqa: E402
+
+
+def get_tool_list(galaxy_instance: GalaxyInstance, tool_filter: ToolFilter, latest: bool):
     """
     get a list of tool IDs from a galaxy instance
 
-    include are applied and if desired only the latest version of each tool is returned
+    the filter is applied and if desired only the latest version of each tool is returned
     """
     tool_client = ToolClient(galaxy_instance)
     tools = tool_client.get_tools()
@@ -31,9 +38,7 @@ def get_tool_list(galaxy_instance: GalaxyInstance, include: List[str], exclude:
     tool_versions = {}
     for tool in tools:
         tool_id = tool["id"]
-        if include and not any([re.search(f, tool_id) for f in include]):
-            continue
-        if exclude and any([re.search(f, tool_id) for f in exclude]):
+        if not tool_filter(tool_id):
             continue
         tool_id = remove_version_from_guid(tool_id) or tool_id
     
@@ -75,8 +80,28 @@ parser.add_argument(
     default=[],
     help='filter tool id by searching for regexp, if any filter applies a tool is excluded'
 )
+parser.add_argument(
+    '--include-file',
+    type=str,
+    action='append',
+    default=[],
+    help='file with include regexps (one per line)'
+)
+parser.add_argument(
+    '--exclude-file',
+    type=str,
+    action='append',
+    default=[],
+    help='file with exclude regexps (one per line)'
+)
 parser.add_argument('--latest', action='store_true', default=False, help='consider only the latest version of the tool')
 parser.add_argument('--install_container', action='store_true', default=False, help='install the container')
+parser.add_argument('--jobs', type=int, action='store', default=1, help='number of containers installed in parallel, default=1')
+parser.add_argument('--container-index', type=str, action='store', default=None, help='file storing the index of the container directories between runs')
+parser.add_argument('--chunk-size', type=int, action='store', default=100, help='number of tools resolved per request, default=100')
+parser.add_argument('--snapshot', type=str, action='store', default=None, help='file storing the toolbox resolution, shared with the other container scripts')
+parser.add_argument('--snapshot-ttl', type=float, action='store', default=3600, help='maximum age of the snapshot in seconds, default=3600')
+parser.add_argument('--refresh', action='store_true', default=False, help='ignore the stored snapshot')
 parser.add_argument( '-log',
                      '--loglevel',
                      choices=['debug', 'info', 'warning', 'error'],
@@ -96,39 +121,65 @@ logger.addHandler(handler)
 # Add a formatter to the handler (optional)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
+logging.getLogger("scheduler").setLevel(args.loglevel.upper())
+logging.getLogger("scheduler").addHandler(handler)
+logging.getLogger("toolbox_snapshot").setLevel(args.loglevel.upper())
+logging.getLogger("toolbox_snapshot").addHandler(handler)
 
 key = os.environ.get('GALAXY_API_KEY', args.key)
 galaxy_instance = GalaxyInstance(url=args.url, key=key)
 
 # get tools (matching filters and latest arguments)
-tool_list = get_tool_list(galaxy_instance, args.include, args.exclude, args.latest)
+include = args.include + [p for f in args.include_file for p in read_patterns(f)]
+exclude = args.exclude + [p for f in args.exclude_file for p in read_patterns(f)]
+tool_list = get_tool_list(galaxy_instance, ToolFilter(include, exclude), args.latest)
 
-new_containers = set()
+# resolve the tools in chunks and collect the tools per missing container
 container_resolution_client = ContainerResolutionClient(galaxy_instance = galaxy_instance)
-for tool in tool_list:
-    logger.debug(f"Checking {tool}")
-    res = container_resolution_client.resolve_toolbox(tool_ids = [tool])
-    container = None
-    for i, r in enumerate(res):
-        tool_id = r['tool_id']
-        container = r["status"].get("environment_path")
-    
-    if container is None:
-        logger.debug(f"No container for for {tool}")
-        continue
-
-    if os.path.exists(container):
-        logger.debug(f"Container for {tool} already installed {os.path.basename(container)}")
-        continue
-
-    res = container_resolution_client.resolve_toolbox(tool_ids = [tool], install=args.install_container)
-    for i, r in enumerate(res):
-        tool_id = r['tool_id']
-        new_container = r["status"].get("environment_path")
-
-        if new_container and os.path.exists(new_container):
-            print(f"Installed {new_container}")
-        elif not args.install_container:
-            logger.warning(f"Skipped installation of {new_container}")
-        else:
-            logger.error(f"Could not install container for {tool} {container=} {new_container=}")
+container_store = ContainerStore(args.container_index)
+snapshot = ToolboxSnapshot(galaxy_instance, args.snapshot, args.snapshot_ttl, args.refresh)
+tools_by_container = {}
+for start in range(0, len(tool_list), args.chunk_size):
+    chunk = tool_list[start:start + args.chunk_size]
+    logger.debug(f"Checking {len(chunk)} tools ({start + len(chunk)}/{len(tool_list)})")
+    if args.snapshot:
+        res = snapshot.resolution(tool_ids = chunk)
+    else:
+        res = container_resolution_client.resolve_toolbox(tool_ids = chunk)
+    containers = {}
+    for r in res:
+        containers[r['tool_id']] = r["status"].get("environment_path")
+
+    for tool in chunk:
+        container = containers.get(tool)
+        if container is None:
+            logger.debug(f"No container for for {tool}")
+            continue
+        if container_store.exists(container):
+            logger.debug(f"Container for {tool} already installed {os.path.basename(container)}")
+            continue
+        tools_by_container.setdefault(container, []).append(tool)
+container_store.save()
+
+if not args.install_container:
+    for container, tools in tools_by_container.items():
+        logger.warning(f"Skipped installation of {container} ({', '.join(tools)})")
+    exit(0)
+
+# each container is installed only once, also if it is used by several tools
+start = time.monotonic()
+results = install_containers(container_resolution_client, tools_by_container, args.jobs)
+duration = time.monotonic() - start
+installed = [r for r in results if r["installed"]]
+if installed:
+    snapshot.invalidate("resolution")
+for r in installed:
+    container_store.forget(r["container"])
+    print(f"Installed {r['container']}")
+container_store.save()
+size = sum(r["size"] for r in installed)
+logger.info(
+    f"Installed {len(installed)}/{len(results)} containers ({size / 1024**3:.1f} GB) in {duration:.0f}s"
+)
+if len(installed) < len(results):
+    exit(1)
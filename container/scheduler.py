@@ -0,0 +1,75 @@
+"""
+Concurrent installation of containers
+
+each container is installed once (by resolving one of the tools that
+use it with install=True), installations run in a pool of jobs and
+failures of single installations do not stop the others
+"""
+
+import logging
+import os.path
+import time
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+def install_container(container_resolution_client, container: str, tool_id: str) -> dict:
+    """
+    install the container via the resolution of tool_id and return
+    a summary (container, tool_id, installed, duration, size, error)
+    """
+    result = {
+        "container": container,
+        "tool_id": tool_id,
+        "installed": False,
+        "duration": 0.0,
+        "size": 0,
+        "error": None,
+    }
+    start = time.monotonic()
+    try:
+        res = container_resolution_client.resolve_toolbox(tool_ids=[tool_id], install=True)
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    finally:
+        result["duration"] = time.monotonic() - start
+    for r in res:
+        new_container = r["status"].get("environment_path")
+        if new_container and os.path.exists(new_container):
+            result["container"] = new_container
+            result["installed"] = True
+            result["size"] = os.path.getsize(new_container)
+    if not result["installed"]:
+        result["error"] = f"container missing after installation {res}"
+    return result
+
+
+def install_containers(
+    container_resolution_client, tools_by_container: Dict[str, List[str]], jobs: int
+) -> List[dict]:
+    """
+    install the containers (mapping from container path to the tools
+    using it) with up to jobs parallel installations
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(install_container, container_resolution_client, container, tools[0])
+            for container, tools in tools_by_container.items()
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["installed"]:
+                throughput = result["size"] / result["duration"] / 1024**2 if result["duration"] else 0
+                logger.info(
+                    f"Installed {result['container']} in {result['duration']:.1f}s ({throughput:.1f} MB/s)"
+                )
+            else:
+                logger.error(
+                    f"Could not install container for {result['tool_id']} {result['container']}: {result['error']}"
+                )
+    return results
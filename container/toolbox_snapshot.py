@@ -0,0 +1,124 @@
+"""
+Snapshot of the toolbox dependency summary and container resolution
+
+summarize_toolbox and resolve_toolbox are expensive, the responses are
+stored in a file together with the time they were fetched and a
+fingerprint of the toolbox (ids and versions of all tools). the
+container scripts can share the file, a stored response is reused as
+long as it is younger than the TTL and the toolbox did not change
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import time
+from typing import List, Optional
+
+from bioblend.galaxy import GalaxyInstance
+from bioblend.galaxy.container_resolution import ContainerResolutionClient
+from bioblend.galaxy.tool_dependencies import ToolDependenciesClient
+from bioblend.galaxy.tools import ToolClient
+
+logger = logging.getLogger(__name__)
+
+
+class ToolboxSnapshot:
+    """
+    cached summarize_toolbox(index_by="tools") and resolve_toolbox() responses
+
+    without a path the responses are only kept in memory,
+    with refresh stored responses are ignored (and replaced)
+    """
+
+    def __init__(
+        self,
+        galaxy_instance: GalaxyInstance,
+        path: Optional[str] = None,
+        ttl: float = 3600,
+        refresh: bool = False,
+    ):
+        self.galaxy_instance = galaxy_instance
+        self.path = path
+        self.ttl = ttl
+        self._fingerprint = None
+        self._data = {"url": galaxy_instance.base_url, "responses": {}}
+        if path and os.path.exists(path) and not refresh:
+            with open(path) as fh:
+                stored = json.load(fh)
+            if stored.get("url") == galaxy_instance.base_url:
+                self._data = stored
+
+    def fingerprint(self) -> str:
+        """
+        hash of the ids and versions of all tools in the toolbox
+        """
+        if self._fingerprint is None:
+            tools = ToolClient(self.galaxy_instance).get_tools()
+            tool_versions = sorted(f"{t['id']}\t{t.get('version')}" for t in tools)
+            self._fingerprint = hashlib.sha256(
+                "\n".join(tool_versions).encode()
+            ).hexdigest()
+        return self._fingerprint
+
+    def _get(self, name: str, fetch):
+        stored = self._data["responses"].get(name)
+        if stored is not None:
+            age = time.time() - stored["time"]
+            if age > self.ttl:
+                logger.debug(f"Snapshot of {name} expired ({age:.0f}s old)")
+            elif stored["fingerprint"] != self.fingerprint():
+                logger.debug(f"Snapshot of {name} is for a different toolbox")
+            else:
+                logger.debug(f"Using snapshot of {name} ({age:.0f}s old)")
+                return stored["response"]
+        logger.debug(f"Fetching {name}")
+        now = time.time()
+        response = fetch()
+        self._data["responses"][name] = {
+            "time": now,
+            "fingerprint": self.fingerprint(),
+            "response": response,
+        }
+        self.save()
+        return response
+
+    def summary(self) -> List[dict]:
+        """
+        response of summarize_toolbox(index_by="tools")
+        """
+        client = ToolDependenciesClient(galaxy_instance=self.galaxy_instance)
+        return self._get(
+            "summary", lambda: client.summarize_toolbox(index_by="tools")
+        )
+
+    def resolution(self, tool_ids: Optional[List[str]] = None) -> List[dict]:
+        """
+        response of resolve_toolbox() for the whole toolbox
+        or the entries for the given tools
+        """
+        client = ContainerResolutionClient(galaxy_instance=self.galaxy_instance)
+        res = self._get("resolution", client.resolve_toolbox)
+        if tool_ids is None:
+            return res
+        tool_ids = set(tool_ids)
+        return [r for r in res if r["tool_id"] in tool_ids]
+
+    def invalidate(self, name: str):
+        """
+        drop a stored response (e.g. after installing containers
+        or removing conda environments)
+        """
+        if self._data["responses"].pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        """
+        store the snapshot (if a path is configured)
+        """
+        if not self.path:
+            return
+        with open(f"{self.path}.tmp", "w") as fh:
+            json.dump(self._data, fh)
+        os.replace(f"{self.path}.tmp", self.path)
@@ -5,18 +5,42 @@ A dangling library data set is a non-deleted dataset
 that is contained in a subtree with a root that is a
 deleted folder/library
 
-Therefore the script recursively crawls all deleted
-and nondeleted libraries and contained folders.
+Therefore the script crawls all deleted and nondeleted
+libraries and contained folders (breadth first, folders
+are listed concurrently). With --cache the folder listings
+are stored and reused in the next run for folders whose
+update time and item count did not change (the current state of
+each folder is requested with show_folder). Deleting a dataset
+does not change its folder, i.e. after deletions made outside
+of this script (e.g. in the UI) use --refresh.
+
+With --plan the dangling folders and datasets are written to
+a file (json lines) that can be reviewed and applied later
+with --apply (without crawling again). With --cache the listings
+of the folders containing the plan items are dropped.
+
+With --du the number and size of live, deleted and dangling
+files is reported for each folder and library (subtree).
 """
 
 import argparse
+import json
 import logging
 import os
 import os.path
+import sys
+from concurrent.futures import as_completed, FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import humanize
 from bioblend.galaxy import GalaxyInstance
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from resumable import Checkpoint, RateLimiter  # noqa: E402
+from tables import write_table  # noqa: E402
+
+# disk usage categories: files that are live, deleted, or dangling
+DU_CATEGORIES = ["live", "deleted", "dangling"]
+
 USER_BATCH_SIZE = 10000
 
 parser = argparse.ArgumentParser(
@@ -39,6 +63,69 @@ parser.add_argument(
     default=False,
     help="Really delete",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    action="store",
+    default=1,
+    help="number of folders that are listed in parallel, default=1",
+)
+parser.add_argument(
+    "--plan",
+    type=str,
+    action="store",
+    default=None,
+    help="write the dangling folders and datasets to this file (json lines)",
+)
+parser.add_argument(
+    "--apply",
+    type=str,
+    action="store",
+    default=None,
+    help="delete the folders and datasets of a plan file (no crawl)",
+)
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    action="store",
+    default=None,
+    help="file recording the applied plan items, default: plan file + .checkpoint",
+)
+parser.add_argument(
+    "--rate",
+    type=float,
+    action="store",
+    default=None,
+    help="maximum number of delete requests per second for --apply, default: unlimited",
+)
+parser.add_argument(
+    "--du",
+    type=str,
+    action="store",
+    default=None,
+    help="write file counts and sizes of each folder subtree to this file (csv, or parquet if it ends with .parquet)",
+)
+parser.add_argument(
+    "--top",
+    type=int,
+    action="store",
+    default=20,
+    help="number of largest subtrees printed with --du, default=20",
+)
+parser.add_argument(
+    "--cache",
+    type=str,
+    action="store",
+    default=None,
+    help="file storing the folder listings, listings of unchanged folders are reused "
+    "(use --refresh after deleting library content outside of this script)",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    default=False,
+    help="ignore the cached folder listings",
+)
 parser.add_argument(
     "-log",
     "--loglevel",
@@ -68,45 +155,296 @@ users = gi.users.get_users()
 usernames = set(user.get("username") for user in users)
 
 
-def recurse(library, folder, deleted, full_path, folder_cnt, file_cnt, file_size):
-    full_path += f"/{folder['name']}"
-    folder_id = folder["id"]
-    deleted = folder["deleted"] or deleted
-    for content in gi.folders.contents_iter(folder_id=folder_id, batch_size=1000, include_deleted=True):
-        if content["type"] == "folder":
-            folder_cnt, file_cnt, file_size = recurse(
-                library, content, deleted, full_path, folder_cnt, file_cnt, file_size
+def list_folder(folder_id):
+    return list(
+        gi.folders.contents_iter(folder_id=folder_id, batch_size=1000, include_deleted=True)
+    )
+
+
+def load_crawl_cache(path):
+    """
+    load the cached folder listings, empty if there are none
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def save_crawl_cache(path, cache):
+    """
+    store the folder listings (atomically)
+    """
+    with open(f"{path}.tmp", "w") as fh:
+        json.dump(cache, fh)
+    os.replace(f"{path}.tmp", path)
+
+
+def write_plan_item(fh, item_type, library, folder_id, content, full_path):
+    """
+    add a dangling folder or dataset to the plan (a json object per line)
+
+    folder_id is the folder containing the item, its cached listing
+    is dropped when the plan is applied
+    """
+    item = {
+        "type": item_type,
+        "library_id": library["id"],
+        "folder_id": folder_id,
+        "id": content["id"],
+        "name": content["name"],
+        "path": full_path,
+        "size": content.get("raw_size", 0),
+    }
+    fh.write(f"{json.dumps(item)}\n")
+
+
+def folder_key(folder):
+    """
+    key of a folder in the crawl cache, the cached listing is reused
+    as long as the key is unchanged
+    """
+    return [folder.get("update_time"), folder.get("item_count")]
+
+
+def load_folder(folder_id, key, cached, revalidate):
+    """
+    contents of a folder, the cached listing is reused if the key is unchanged
+
+    with revalidate the rows of the subfolders are updated with their
+    current details (show_folder), i.e. the keys and deleted flags of
+    subfolders are never taken from a cached listing
+    """
+    if cached and any(key) and cached["key"] == key:
+        contents = [dict(content) for content in cached["contents"]]
+    else:
+        contents = list_folder(folder_id)
+    if revalidate:
+        for content in contents:
+            if content["type"] != "folder":
+                continue
+            details = gi.folders.show_folder(content["id"])
+            content["deleted"] = details["deleted"]
+            content["update_time"] = details.get("update_time")
+            content["item_count"] = details.get("item_count")
+    return contents
+
+
+def crawl(libraries, workers, cache, new_cache, revalidate):
+    """
+    traverse the folders of all libraries breadth first
+
+    folders are listed concurrently by a pool of workers. listings from
+    cache (folder id -> key and contents) are reused if the current key of
+    the folder is unchanged, all listings are stored in new_cache. for
+    caching revalidate must be set, then the key and deleted flag of each
+    folder are fetched with show_folder. yields
+    (library, folder_id, full_path, deleted, contents) for each folder, where
+    deleted is True if the folder, one of its ancestors, or the library is
+    deleted
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # frontier: listing future -> (library, folder id, key, full path, deleted)
+        pending = {}
+
+        def submit(library, folder, deleted, parent_path):
+            full_path = f"{parent_path}/{folder['name']}"
+            deleted = folder["deleted"] or deleted
+            key = folder_key(folder)
+            cached = cache.get(folder["id"])
+            future = executor.submit(load_folder, folder["id"], key, cached, revalidate)
+            pending[future] = (library, folder["id"], key, full_path, deleted)
+
+        if revalidate:
+            root_folders = executor.map(
+                lambda library: gi.folders.show_folder(library["root_folder_id"]),
+                libraries,
             )
+        else:
+            root_folders = executor.map(
+                lambda library: gi.libraries.show_folder(
+                    library_id=library["id"], folder_id=library["root_folder_id"]
+                ),
+                libraries,
+            )
+        for library, root_folder in zip(libraries, root_folders):
+            logger.info(f"Processing library {library['name']}")
+            submit(library, root_folder, library["deleted"], "")
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                library, folder_id, key, full_path, deleted = pending.pop(future)
+                contents = future.result()
+                new_cache[folder_id] = {"key": key, "contents": contents}
+                for content in contents:
+                    if content["type"] == "folder":
+                        submit(library, content, deleted, full_path)
+                yield library, folder_id, full_path, deleted, contents
+
+
+def apply_plan_item(item):
+    """
+    delete a dangling folder or purge a dangling dataset of the plan
+    """
+    rate_limiter.wait()
+    if item["type"] == "folder":
+        gi.folders.delete_folder(item["id"])
+    else:
+        gi.libraries.delete_library_dataset(item["library_id"], item["id"], purged=True)
+    checkpoint.add(item["id"])
+
+
+# apply a plan written by an earlier run, no crawling needed
+if args.apply:
+    with open(args.apply) as fh:
+        plan = [json.loads(line) for line in fh if line.strip()]
+    checkpoint = Checkpoint(args.checkpoint or f"{args.apply}.checkpoint")
+    rate_limiter = RateLimiter(args.rate)
+    todo = [item for item in plan if item["id"] not in checkpoint]
+    if args.cache:
+        # the deletions do not change the key of the containing folders,
+        # so their listings are dropped (before deleting, i.e. also if
+        # the run is interrupted)
+        crawl_cache = load_crawl_cache(args.cache)
+        for item in plan:
+            if "folder_id" not in item:
+                logger.warning(f"Plan item {item['id']} without folder, use --refresh for the next crawl")
+            crawl_cache.pop(item.get("folder_id"), None)
+        save_crawl_cache(args.cache, crawl_cache)
+    logger.info(f"Applying {len(todo)}/{len(plan)} deletions of {args.apply}")
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(apply_plan_item, item): item for item in todo}
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                item = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Could not delete {item['type']} '{item['name']}' in {item['path']}: {e}")
+                    failed += 1
+                    continue
+                logger.info(f"Deleted {item['type']} '{item['name']}' in {item['path']} ({done}/{len(todo)})")
+        except KeyboardInterrupt:
+            # running deletions finish (and are checkpointed), queued ones are dropped
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            checkpoint.close()
+    if failed:
+        sys.exit(f"Could not delete {failed}/{len(todo)} plan items")
+    sys.exit(0)
+
+plan_fh = open(args.plan, "w") if args.plan else None
 
+crawl_cache = load_crawl_cache(None if args.refresh else args.cache)
+new_crawl_cache = {}
+
+# disk usage: folder id -> library, path and [count, bytes] per category
+# (first of the folder itself, after the crawl of the subtree)
+du_folders = {}
+du_parents = {}
+
+libraries = gi.libraries.get_libraries(deleted=None)
+# library id -> [folder count, file count, file size] of dangling content
+dangling = {library["id"]: [0, 0, 0] for library in libraries}
+for library, folder_id, full_path, deleted, contents in crawl(
+    libraries, args.workers, crawl_cache, new_crawl_cache, bool(args.cache)
+):
+    counts = dangling[library["id"]]
+    if args.du:
+        du = [0] * (2 * len(DU_CATEGORIES))
+        du_folders[folder_id] = (library, full_path, du)
+        for content in contents:
+            if content["type"] == "folder":
+                du_parents[content["id"]] = folder_id
+            elif content["type"] == "file":
+                if content["deleted"]:
+                    category = DU_CATEGORIES.index("deleted")
+                elif deleted:
+                    category = DU_CATEGORIES.index("dangling")
+                else:
+                    category = DU_CATEGORIES.index("live")
+                du[2 * category] += 1
+                du[2 * category + 1] += content.get("raw_size") or 0
+    for content in contents:
         if content["type"] == "folder":
             if not content["deleted"] and deleted:
-                folder_cnt += 1
+                counts[0] += 1
+                if plan_fh:
+                    write_plan_item(plan_fh, "folder", library, folder_id, content, full_path)
                 if args.delete:
                     gi.folders.delete_folder(content["id"])
+                    # the listing is outdated now
+                    new_crawl_cache.pop(folder_id, None)
                 logger.debug(f"Dangling folder '{content['name']}' at {full_path}")
         elif content["type"] == "file":
             if not content["deleted"] and deleted:
-                file_cnt += 1
-                file_size += content["raw_size"]
+                counts[1] += 1
+                counts[2] += content["raw_size"]
+                if plan_fh:
+                    write_plan_item(plan_fh, "file", library, folder_id, content, full_path)
                 if args.delete:
                     gi.libraries.delete_library_dataset(library["id"], content["id"], purged=True)
+                    new_crawl_cache.pop(folder_id, None)
                 logger.debug(
                     f"Dangling dataset '{content['name']}' ({humanize.naturalsize(content['raw_size'], binary=False)}) in {full_path}"
                 )
         else:
             logger.error(
-                f"Unknown content type: {content['type']} at {full_path_str=} {content=}"
+                f"Unknown content type: {content['type']} at {full_path=} {content=}"
             )
-    return folder_cnt, file_cnt, file_size
 
+if plan_fh:
+    plan_fh.close()
+
+if args.cache:
+    save_crawl_cache(args.cache, new_crawl_cache)
+
+if args.du:
+    # sum up subtrees, folders are visited after their parent
+    # (breadth first), i.e. in reverse order children come first
+    for folder_id in reversed(list(du_folders)):
+        parent_id = du_parents.get(folder_id)
+        if parent_id is None:
+            continue
+        parent_du = du_folders[parent_id][2]
+        for i, value in enumerate(du_folders[folder_id][2]):
+            parent_du[i] += value
+    columns = {
+        "library_id": [],
+        "library": [],
+        "folder_id": [],
+        "path": [],
+    }
+    for category in DU_CATEGORIES:
+        columns[f"{category}_files"] = []
+        columns[f"{category}_bytes"] = []
+    for folder_id, (library, full_path, du) in du_folders.items():
+        columns["library_id"].append(library["id"])
+        columns["library"].append(library["name"])
+        columns["folder_id"].append(folder_id)
+        columns["path"].append(full_path)
+        for i, category in enumerate(DU_CATEGORIES):
+            columns[f"{category}_files"].append(du[2 * i])
+            columns[f"{category}_bytes"].append(du[2 * i + 1])
+    write_table(args.du, columns)
+
+    def total_bytes(folder_id):
+        return sum(du_folders[folder_id][2][1::2])
+
+    for folder_id in sorted(du_folders, key=total_bytes, reverse=True)[: args.top]:
+        library, full_path, du = du_folders[folder_id]
+        sizes = ", ".join(
+            f"{category} {humanize.naturalsize(du[2 * i + 1], binary=False)}"
+            for i, category in enumerate(DU_CATEGORIES)
+        )
+        print(f"{humanize.naturalsize(total_bytes(folder_id), binary=False)}\t{full_path} ({sizes})")
 
-libraries = gi.libraries.get_libraries(deleted=None)
 for library in libraries:
-    root_folder = gi.libraries.show_folder(
-        library_id=library["id"], folder_id=library["root_folder_id"]
-    )
-    logger.info(f"Processing library {library['name']}")
-    folder_cnt, file_cnt, file_size = recurse(library, root_folder, library["deleted"], "", 0, 0, 0)
+    folder_cnt, file_cnt, file_size = dangling[library["id"]]
     # TODO  check root folder""
     if folder_cnt + file_cnt + file_size > 0:
         logger.warning(
@@ -0,0 +1,190 @@
+"""
+Maintenance of user import directories without external processes
+
+- POSIX ACLs are set via the system.posix_acl_* extended attributes
+  (same effect as setfacl -m)
+- a single os.scandir walk deletes expired files (like find -mtime +N -delete)
+  and checks if ownership needs to be fixed, only then the chown script
+  is called via sudo
+"""
+
+import errno
+import logging
+import os
+import os.path
+import grp
+import pwd
+import stat
+import struct
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHOWN_SCRIPT = "/global/apps/galaxy/scripts/external_chown_script.py"
+
+# see linux/posix_acl_xattr.h
+ACL_ACCESS = "system.posix_acl_access"
+ACL_DEFAULT = "system.posix_acl_default"
+ACL_EA_VERSION = 0x0002
+ACL_USER_OBJ = 0x01
+ACL_USER = 0x02
+ACL_GROUP_OBJ = 0x04
+ACL_GROUP = 0x08
+ACL_MASK = 0x10
+ACL_OTHER = 0x20
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+
+HEADER = struct.Struct("<I")
+ENTRY = struct.Struct("<HHI")
+
+Acl = Dict[Tuple[int, int], int]
+
+
+def _acl_from_mode(mode: int) -> Acl:
+    return {
+        (ACL_USER_OBJ, ACL_UNDEFINED_ID): (mode >> 6) & 7,
+        (ACL_GROUP_OBJ, ACL_UNDEFINED_ID): (mode >> 3) & 7,
+        (ACL_OTHER, ACL_UNDEFINED_ID): mode & 7,
+    }
+
+
+def read_acl(path: str, name: str) -> Optional[Acl]:
+    """
+    get the ACL stored in the extended attribute name, None if there is none
+    """
+    try:
+        data = os.getxattr(path, name, follow_symlinks=False)
+    except OSError as e:
+        if e.errno == errno.ENODATA:
+            return None
+        raise
+    (version,) = HEADER.unpack_from(data)
+    if version != ACL_EA_VERSION:
+        raise ValueError(f"unsupported ACL version {version} for {path}")
+    acl = {}
+    for offset in range(HEADER.size, len(data), ENTRY.size):
+        tag, perm, qualifier = ENTRY.unpack_from(data, offset)
+        acl[(tag, qualifier)] = perm
+    return acl
+
+
+def write_acl(path: str, name: str, acl: Acl):
+    """
+    store the ACL in the extended attribute name
+    """
+    data = HEADER.pack(ACL_EA_VERSION) + b"".join(
+        ENTRY.pack(tag, perm, qualifier)
+        for (tag, qualifier), perm in sorted(acl.items())
+    )
+    os.setxattr(path, name, data, follow_symlinks=False)
+
+
+def modify_acl(path: str, users: List[str]):
+    """
+    grant rwX to the given users and set the mask to rwx for the
+    access ACL and (for directories) the default ACL of path
+
+    this corresponds to setfacl -m u:USER:rwX -m d:u:USER:rwX -m m::rwx -m d:m::rwx
+    """
+    st = os.stat(path, follow_symlinks=False)
+    is_dir = stat.S_ISDIR(st.st_mode)
+    # X: execute only for directories or if some user can already execute
+    perm = 7 if is_dir or st.st_mode & 0o111 else 6
+    uids = [pwd.getpwnam(user).pw_uid for user in users]
+
+    access = read_acl(path, ACL_ACCESS) or _acl_from_mode(st.st_mode)
+    names = [(ACL_ACCESS, access)]
+    if is_dir:
+        default = read_acl(path, ACL_DEFAULT)
+        if default is None:
+            # a new default ACL starts with the base entries of the access ACL
+            default = {
+                k: v
+                for k, v in access.items()
+                if k[0] in (ACL_USER_OBJ, ACL_GROUP_OBJ, ACL_OTHER)
+            }
+        names.append((ACL_DEFAULT, default))
+    for name, acl in names:
+        for uid in uids:
+            acl[(ACL_USER, uid)] = perm
+        acl[(ACL_MASK, ACL_UNDEFINED_ID)] = 7
+        write_acl(path, name, acl)
+
+
+def scan_import_dir(
+    path: str, owner: str, group: str, max_age_days: Optional[int] = None
+) -> Tuple[bool, List[str]]:
+    """
+    walk the directory once, delete regular files older than max_age_days
+    and check if all entries are owned by owner:group
+
+    returns if ownership needs fixing and the expired files that could not
+    be deleted. directories that can not be read also need fixing (their
+    content is skipped), entries that disappear during the walk are ignored
+    """
+    uid = pwd.getpwnam(owner).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    now = time.time()
+    st = os.stat(path, follow_symlinks=False)
+    needs_chown = st.st_uid != uid or st.st_gid != gid
+    undeleted = []
+    stack = [path]
+    while stack:
+        dirname = stack.pop()
+        try:
+            it = os.scandir(dirname)
+        except PermissionError:
+            logger.debug(f"Can not read {dirname}")
+            needs_chown = True
+            continue
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                except PermissionError:
+                    needs_chown = True
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif (
+                    max_age_days is not None
+                    and entry.is_file(follow_symlinks=False)
+                    # find -mtime +N: age in whole days greater than N
+                    and (now - st.st_mtime) // 86400 > max_age_days
+                ):
+                    try:
+                        os.unlink(entry.path)
+                        logger.debug(f"Deleted expired file {entry.path}")
+                        continue
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        logger.debug(f"Could not delete {entry.path}: {e}")
+                        undeleted.append(entry.path)
+                if st.st_uid != uid or st.st_gid != gid:
+                    needs_chown = True
+    return needs_chown, undeleted
+
+
+def maintain_import_dir(path: str, owner: str, group: str, max_age_days: int):
+    """
+    fix ownership of an existing import directory and delete expired files
+
+    the chown script is only called (via sudo) if some entry is not owned
+    by owner:group or can not be read, then the directory is walked again
+    to delete the expired files that were not accessible before
+    """
+    needs_chown, undeleted = scan_import_dir(path, owner, group, max_age_days)
+    if needs_chown:
+        logger.debug(f"Fixing ownership of {path}")
+        proc = subprocess.run(["sudo", CHOWN_SCRIPT, path, owner, group])
+        proc.check_returncode()
+        _, undeleted = scan_import_dir(path, owner, group, max_age_days)
+    if undeleted:
+        raise PermissionError(f"Could not delete {len(undeleted)} files in {path}")
@@ -1,10 +1,24 @@
 import argparse
 import logging
 import os
-import subprocess
+import sys
+from concurrent.futures import as_completed, ThreadPoolExecutor
 
 from bioblend.galaxy import GalaxyInstance
-from ldap3 import Connection, SUBTREE
+from ldap3 import Connection
+
+from import_dirs import maintain_import_dir, modify_acl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from ldap_cache import sync_ldap_users  # noqa: E402
+from ldap_users import iter_ldap_users  # noqa: E402
+
+# permission of library folders -> key in the current permissions
+PERMISSION_KEYS = {
+    "add": "add_library_item_role_list",
+    "manage": "manage_folder_role_list",
+    "modify": "modify_folder_role_list",
+}
 
 parser = argparse.ArgumentParser(
     description="List or remove user import libraries of users deleted users"
@@ -28,6 +42,26 @@ parser.add_argument(
     default=None,
     help="URL of the LDAP server",
 )
+parser.add_argument(
+    "--ldap-cache",
+    type=str,
+    action="store",
+    default=None,
+    help="SQLite file with a snapshot of the LDAP users, only changes are fetched if given",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    default=False,
+    help="do not change anything, list pending folder and permission changes",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    action="store",
+    default=1,
+    help="number of users that are provisioned in parallel, default=1",
+)
 parser.add_argument(
     "-log",
     "--loglevel",
@@ -55,11 +89,13 @@ gi = GalaxyInstance(url=args.url, key=key)
 
 # get LDAP users
 ldap_conn = Connection(args.ldap_url, auto_bind=True)
-base_dn = "ou=people,dc=ufz,dc=de"
-ldap_conn.search(base_dn, "(objectClass=*)", SUBTREE, attributes=["uid", "cn", "mail"])
 ldap_users = dict()
-for entry in ldap_conn.entries:
-    ldap_users[entry.uid.value] = entry.cn.value
+if args.ldap_cache:
+    for uid, entry in sync_ldap_users(ldap_conn, args.ldap_cache).items():
+        ldap_users[uid] = entry["cn"]
+else:
+    for entry in iter_ldap_users(ldap_conn, ["uid", "cn"]):
+        ldap_users[entry["uid"]] = entry["cn"]
 ldap_conn.unbind()
 logger.info(f"Found {len(ldap_users)} users in LDAP")
 
@@ -87,80 +123,53 @@ else:
 uil_id = uil["id"]
 uil_root_folder_id = uil["root_folder_id"]
 
+# index of the user folders in the user import library (one listing of the
+# root folder instead of one get_folders request per user)
+user_folders = {}
+for content in gi.folders.contents_iter(folder_id=uil_root_folder_id, batch_size=1000):
+    if content["type"] != "folder":
+        continue
+    user_folders.setdefault(content["name"], []).append(content)
+logger.info(f"Found {len(user_folders)} user folders in user_data")
+
 # get roles for setting library permissions
 roles = {}
 for r in gi.roles.get_roles():
     roles[r["name"]] = r["id"]
 
-# create library import folders in the user import library
-# - skip sonkurs and songalax
-users = gi.users.get_users()
-for user in users:
-    # logging.debug(f"{user=}")
-    userid = user["id"]
+
+def provision_user(user):
+    """
+    create/maintain the import directory and the library folder of a user
+    """
     username = user["username"]
     email = user["email"]
 
     common_name = ldap_users.get(username)
     if not common_name:
         logging.error(f"User {username} absent in LDAP")
-        continue
+        return
     if username.startswith("sonkurs") or username == "songalax":
-        continue
+        return
 
     # create directory
     import_dir = os.path.join(user_library_import_dir, email)
     if import_dir.startswith("/gpfs"):
         import_dir = import_dir[6:]
-    if not os.path.exists(import_dir):
+    if args.dry_run:
+        logger.debug(f"Skip maintenance of {import_dir}")
+    elif not os.path.exists(import_dir):
         os.mkdir(import_dir)
-        proc = subprocess.run(
-            [
-                "setfacl",
-                "-R",
-                "-m",
-                "u:songalax:rwX",
-                "-m",
-                "d:u:songalax:rwX",
-                import_dir,
-            ]
-        )
-        proc.check_returncode()
-        proc = subprocess.run(
-            [
-                "setfacl",
-                "-R",
-                "-m",
-                f"u:{username}:rwX",
-                "-m",
-                f"d:u:{username}:rwX",
-                import_dir,
-            ]
-        )
-        proc.check_returncode()
-        proc = subprocess.run(
-            ["setfacl", "-R", "-m", "m::rwx", "-m", "d:m::rwx", import_dir]
-        )
-        proc.check_returncode()
+        modify_acl(import_dir, ["songalax", username])
     else:
-        proc = subprocess.run(
-            [
-                "sudo",
-                "/global/apps/galaxy/scripts/external_chown_script.py",
-                import_dir,
-                "songalax",
-                "eve_galaxy",
-            ]
-        )
-        proc.check_returncode()
-        proc = subprocess.run(
-            ["find", import_dir, "-type", "f", "-mtime", "+60", "-delete"]
-        )
-        proc.check_returncode()
+        maintain_import_dir(import_dir, "songalax", "eve_galaxy", max_age_days=60)
 
     # create library folder for the user
-    uif = gi.libraries.get_folders(uil_id, name=f"/{username}")
+    uif = user_folders.get(username, [])
     if len(uif) == 0:
+        if args.dry_run:
+            print(f"{username}: create library folder and set permissions")
+            return
         uif = gi.folders.create_folder(
             uil_root_folder_id, name=username, description=common_name
         )
@@ -169,15 +178,50 @@ for user in users:
         uif = uif[0]
     else:
         logging.error(f"Found more than one library import folder for uname {username}")
-        for f in uif[1:]:
-            gi.folders.delete_folder(f["id"])
+        if not args.dry_run:
+            for f in uif[1:]:
+                gi.folders.delete_folder(f["id"])
         uif = uif[0]
 
-    # set permissions
+    # set permissions (only if they differ from the current ones)
     user_role_id = roles[email]
+    current = gi.folders.get_permissions(uif["id"], scope="current")
+    pending = [
+        permission
+        for permission, key in PERMISSION_KEYS.items()
+        if set(role[1] for role in current.get(key, [])) != {user_role_id}
+    ]
+    if not pending:
+        logger.debug(f"Permissions of {username} are up to date")
+        return
+    if args.dry_run:
+        print(f"{username}: set {', '.join(pending)} permissions")
+        return
     gi.folders.set_permissions(
         uif["id"],
         add_ids=[user_role_id],
         manage_ids=[user_role_id],
         modify_ids=[user_role_id],
     )
+
+
+# create library import folders in the user import library
+# - skip sonkurs and songalax
+# errors are collected per user and reported at the end
+users = gi.users.get_users()
+failed = {}
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    futures = {executor.submit(provision_user, user): user for user in users}
+    for future in as_completed(futures):
+        username = futures[future]["username"]
+        try:
+            future.result()
+        except Exception as e:
+            logger.debug(f"Provisioning {username} failed", exc_info=True)
+            failed[username] = f"{type(e).__name__}: {e}"
+
+logger.info(f"Provisioned {len(users) - len(failed)}/{len(users)} users")
+if failed:
+    for username, error in sorted(failed.items()):
+        logger.error(f"{username}: {error}")
+    exit(f"Provisioning failed for {len(failed)} users")
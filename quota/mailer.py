@@ -0,0 +1,153 @@
+"""
+Queued delivery of notification mails
+
+- mails are put in a queue that is drained by a background thread
+- a single SMTP connection is used for all mails (reconnect on failure)
+- mails that could not be delivered are written to a spool directory
+  and are delivered on the next run (the spool file is only removed
+  after the delivery)
+"""
+
+import json
+import logging
+import os
+import os.path
+import queue
+import smtplib
+import threading
+import uuid
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Mailer:
+    """
+    send mails via a persistent SMTP connection from a background thread
+
+    call start() before queueing mails with send() and close() to
+    wait until all queued mails are processed
+    """
+
+    def __init__(
+        self,
+        sender: str,
+        host: str = "localhost",
+        port: int = 0,
+        spool_dir: Optional[str] = None,
+    ):
+        self.sender = sender
+        self.host = host
+        self.port = port
+        self.spool_dir = spool_dir
+        self.sent = 0
+        self.failed = 0
+        self._server = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """
+        start the delivery thread and queue the mails from the spool
+        """
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            for fname in sorted(os.listdir(self.spool_dir)):
+                if not fname.endswith(".json"):
+                    continue
+                path = os.path.join(self.spool_dir, fname)
+                with open(path) as fh:
+                    spooled = json.load(fh)
+                logger.info(f"Retrying spooled mail to {spooled['receiver']}")
+                self._queue.put((spooled["receiver"], spooled["message"], path))
+        self._thread.start()
+
+    def send(self, receiver_email: str, subject: str, message: str):
+        """
+        queue a plain text mail
+        """
+        msg = MIMEMultipart()
+        msg["From"] = self.sender
+        msg["To"] = receiver_email
+        msg["Subject"] = subject
+        msg.attach(MIMEText(message, "plain"))
+        self._queue.put((receiver_email, msg.as_string(), None))
+
+    def close(self):
+        """
+        wait until the queue is drained and close the SMTP connection
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._disconnect()
+        logger.debug(f"Sent {self.sent} mails, {self.failed} failed")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            receiver_email, message, spool_path = item
+            if self._deliver(receiver_email, message, spool_path):
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def _connect(self):
+        if self._server is None:
+            self._server = smtplib.SMTP(self.host, self.port)
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            self._server.close()
+        self._server = None
+
+    def _deliver(
+        self, receiver_email: str, message: str, spool_path: Optional[str] = None
+    ) -> bool:
+        # a broken connection is reopened once before giving up,
+        # a spooled mail stays in the spool until it is delivered (or refused)
+        for _ in range(2):
+            try:
+                self._connect()
+                self._server.sendmail(self.sender, receiver_email, message)
+                logger.debug(f"Email sent successfully to {receiver_email}")
+                self._unspool(spool_path)
+                return True
+            except smtplib.SMTPRecipientsRefused:
+                logger.error(f"Notification email to {receiver_email} refused")
+                self._unspool(spool_path)
+                return False
+            except (smtplib.SMTPException, OSError) as e:
+                logger.warning(f"Could not send mail to {receiver_email}: {e}")
+                if self._server is not None:
+                    self._server.close()
+                self._server = None
+        logger.error(f"Notification email could not be sent to {receiver_email}")
+        if spool_path is None:
+            self._spool(receiver_email, message)
+        return False
+
+    def _spool(self, receiver_email: str, message: str):
+        if not self.spool_dir:
+            return
+        path = os.path.join(self.spool_dir, f"{uuid.uuid4().hex}.json")
+        with open(path, "w") as fh:
+            json.dump({"receiver": receiver_email, "message": message}, fh)
+        logger.info(f"Spooled mail to {receiver_email} in {path}")
+
+    def _unspool(self, spool_path: Optional[str]):
+        if spool_path is None:
+            return
+        try:
+            os.remove(spool_path)
+        except FileNotFoundError:
+            pass
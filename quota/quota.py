@@ -6,54 +6,185 @@ Script to automatize quota management for single user quotas
 - new quotas can be added (or updated) by adding entries to a file
   "#email\tamount\texpiration dd.mm.yyy"
 - expired quotas are deleted
+- with --snapshot the reconciled state is stored and only new or changed
+  quotas are fetched in the next run. changes made outside of this script
+  (e.g. a quota extended in the admin UI) are not noticed without --full,
+  but cached quotas are fetched again before they are deleted or a
+  notification is sent
 """
 
 import argparse
+import atexit
+import json
 import logging
 import os
-import smtplib
+import re
 import sys
-from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from bioblend import (
     ConnectionError,
     galaxy,
 )
 
+from mailer import Mailer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from tables import write_table  # noqa: E402
+
+# amounts as accepted by Galaxy, e.g. 100G, 1.5TB, 500MiB
+AMOUNT_RE = re.compile(r"^\d+(\.\d+)?([kmgtpe]i?b?|b)?$", re.IGNORECASE)
+REPORT_COLUMNS = [
+    "email",
+    "username",
+    "quota",
+    "quota_bytes",
+    "expiration",
+    "total_disk_usage",
+    "quota_percent",
+]
+
 
 # TODO replace by Galaxy notification?
 def send_notification(receiver_email: str, subject: str, message: str) -> bool:
-    sender_email = "m.bernt@ufz.de"
+    """
+    queue a notification mail, delivery happens in the background
+    """
+    mailer.send(receiver_email, subject, message)
+    return True
 
-    # Create a MIMEText object for the email content
-    msg = MIMEMultipart()
-    msg["From"] = sender_email
-    msg["To"] = receiver_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(message, "plain"))
 
-    # Connect to the SMTP server
-    try:
-        server = smtplib.SMTP("localhost")
-    except ConnectionRefusedError:
-        logger.error("Could not send mail: could not connect to localhost")
-        return False
+def iter_quota_details(quotas, deleted: bool, workers: int, cached: dict):
+    """
+    yield (index, details) for the given quotas as soon as show_quota returns
 
-    # Send the email
-    try:
-        server.sendmail(sender_email, receiver_email, msg.as_string())
-        logger.debug("Email sent successfully!")
-    except Exception as e:
-        logger.error(
-            f"Notification email could not be sent to {receiver_email}. Error:", str(e)
+    details of quotas that are in cached (by id) are yielded first without
+    a request. with more than one worker the show_quota calls are made in a
+    thread pool and the results arrive in completion order, the index allows
+    to restore the order of the quota list
+    """
+    fetch = []
+    for i, quota in enumerate(quotas):
+        if quota["id"] in cached:
+            yield i, cached[quota["id"]]
+        else:
+            fetch.append((i, quota))
+    logger.info(f"Fetching {len(fetch)}/{len(quotas)} quotas ({deleted=})")
+    if workers <= 1:
+        for i, quota in fetch:
+            yield i, gi.quotas.show_quota(quota["id"], deleted=deleted)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(gi.quotas.show_quota, quota["id"], deleted=deleted): i
+            for i, quota in fetch
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def apply_quota_update(update: dict):
+    """
+    create or (undelete and) update a single user quota and notify the user
+    """
+    user = update["user"]
+    if update["action"] == "create":
+        logger.debug(f"Creating quota {user['username']}")
+        gi.quotas.create_quota(
+            name=user["username"],
+            description=update["expiration"],
+            amount=update["amount"],
+            operation="+",
+            in_users=[user["id"]],
+        )
+        send_notification(
+            user['email'],
+            "UFZ Galaxy: quota granted",
+            f"Your additional Galaxy quota of {update['amount']} with expiration date {update['expiration']} has been added."
         )
+        return
+
+    logger.debug(f"Updating quota {user['username']}")
+    if update["action"] == "undelete":
+        gi.quotas.undelete_quota(update["quota_id"])
+    gi.quotas.update_quota(
+        quota_id=update["quota_id"],
+        name=user["username"],
+        description=update["expiration"],
+        default=None,
+        amount=update["amount"],
+        operation="+",
+        in_users=[user["id"]],
+    )
+    send_notification(
+        user['email'],
+        "UFZ Galaxy: quota granted",
+        f"Your additional Galaxy quota of {update['amount']} with expiration date {update['expiration']} has been updated."
+    )
+
+
+def amount_to_bytes(amount: str) -> int:
+    """
+    number of bytes of an amount (all units are powers of 1024, as in Galaxy)
+    """
+    match = re.match(r"^(\d+(?:\.\d+)?)([kmgtpe]?)", amount.lower())
+    return int(float(match.group(1)) * 1024 ** (" kmgtpe".index(match.group(2) or " ")))
+
+
+def quota_unchanged(quota, amount: str, expiration: str) -> bool:
+    """
+    check if the active quota already has the amount and expiration
+    """
+    return (
+        not quota["deleted"]
+        and quota.get("operation", "+") == "+"
+        and quota.get("bytes") == amount_to_bytes(amount)
+        and quota["description"] == expiration
+    )
+
+
+def expiration_due(quota) -> bool:
+    """
+    check if the quota is expired or expires within the notification period
+    """
+    try:
+        expires = datetime.strptime(quota["description"], "%d.%m.%Y")
+    except ValueError:
         return False
+    return datetime.now() > expires - timedelta(days=31)
 
-    # Close the SMTP server connection
-    server.quit()
-    return True
+
+def snapshot_key(quota, deleted: bool) -> list:
+    """
+    key that identifies an unchanged quota in the snapshot
+
+    the update time is used if the quota listing contains it, otherwise
+    the name (changes made outside of this script are then only noticed
+    with --full)
+    """
+    return [deleted, quota.get("update_time", quota["name"])]
+
+
+def load_snapshot(path: str) -> dict:
+    """
+    load the state of the last run, empty state if there is none
+    """
+    if not path or not os.path.exists(path):
+        return {"quotas": {}, "mail2user": {}}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def save_snapshot(path: str, snapshot: dict):
+    """
+    store the state (atomically, i.e. an interrupted run keeps the old one)
+    """
+    if not path:
+        return
+    with open(f"{path}.tmp", "w") as fh:
+        json.dump(snapshot, fh)
+    os.replace(f"{path}.tmp", path)
 
 
 parser = argparse.ArgumentParser(description="List / install containers")
@@ -71,6 +202,61 @@ parser.add_argument(
     default=None,
     help="quota update file: tab separated: email, amount, time",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    action="store",
+    default=1,
+    help="number of parallel requests for fetching quota details, default=1",
+)
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    default=False,
+    help="only print the quota updates planned from the quota update file",
+)
+parser.add_argument(
+    "--report",
+    type=str,
+    action="store",
+    default=None,
+    help="write disk usage of users with a quota to this file (csv, or parquet if it ends with .parquet)",
+)
+parser.add_argument(
+    "--snapshot",
+    type=str,
+    action="store",
+    default=None,
+    help="file storing the reconciled users and quotas, only new or changed quotas are fetched if given "
+    "(quotas edited outside of this script are only noticed with --full)",
+)
+parser.add_argument(
+    "--full",
+    action="store_true",
+    default=False,
+    help="ignore the snapshot and fetch all users and quotas",
+)
+parser.add_argument(
+    "--smtp-host",
+    type=str,
+    action="store",
+    default="localhost",
+    help="SMTP server for notification mails, default=localhost",
+)
+parser.add_argument(
+    "--smtp-port",
+    type=int,
+    action="store",
+    default=25,
+    help="SMTP port, default=25",
+)
+parser.add_argument(
+    "--spool-dir",
+    type=str,
+    action="store",
+    default=None,
+    help="directory for notification mails that could not be sent, they are retried on the next run",
+)
 parser.add_argument(
     "-log",
     "--loglevel",
@@ -92,6 +278,15 @@ logger.addHandler(handler)
 # Add a formatter to the handler (optional)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 handler.setFormatter(formatter)
+logging.getLogger("mailer").setLevel(args.loglevel.upper())
+logging.getLogger("mailer").addHandler(handler)
+
+mailer = Mailer(
+    "m.bernt@ufz.de", host=args.smtp_host, port=args.smtp_port, spool_dir=args.spool_dir
+)
+mailer.start()
+# deliver the queued mails also if the script exits early
+atexit.register(mailer.close)
 
 key = os.environ.get('GALAXY_API_KEY', args.key)
 gi = galaxy.GalaxyInstance(url=args.url, key=key)
@@ -103,18 +298,48 @@ try:
 except ConnectionError:
     sys.exit(f"Could not connect to {args.url}")
 
-users = gi.users.get_users()
+snapshot = load_snapshot(None if args.full else args.snapshot)
 
 # get mapping from email to users
-mail2user = {user["email"]: user for user in users}
+# (the users are only fetched if there is no snapshot or an unknown email
+# is in the quota update file)
+users_fetched = False
+if not snapshot["mail2user"]:
+    users = gi.users.get_users()
+    mail2user = {user["email"]: user for user in users}
+    users_fetched = True
+else:
+    mail2user = snapshot["mail2user"]
+
+# state for the next run (quotas changed in this run are removed)
+new_snapshot = {"quotas": {}, "mail2user": mail2user}
 
 # get mapping from email to quotas
 # and delete expired quotas
 mail2quota = {}
+# ids of quotas whose details are only known from the snapshot
+from_snapshot = set()
 for deleted in [False, True]:
     quotas = gi.quotas.get_quotas(deleted=deleted)
+    cached = {}
     for quota in quotas:
-        quota = gi.quotas.show_quota(quota["id"], deleted=deleted)
+        entry = snapshot["quotas"].get(quota["id"])
+        if entry and entry["key"] == snapshot_key(quota, deleted):
+            cached[quota["id"]] = entry["details"]
+    # (email, quota) at the position of the quota in the list
+    user_quotas = [None] * len(quotas)
+    for i, quota in iter_quota_details(quotas, deleted, args.workers, cached):
+        if quota["id"] in cached and not deleted and expiration_due(quota):
+            # the cached details may be outdated (e.g. the quota has been
+            # extended by an admin) and must not trigger deletions or mails
+            logger.debug(f"Refreshing cached quota {quota['name']}")
+            quota = gi.quotas.show_quota(quota["id"], deleted=deleted)
+        elif quota["id"] in cached:
+            from_snapshot.add(quota["id"])
+        new_snapshot["quotas"][quota["id"]] = {
+            "key": snapshot_key(quotas[i], deleted),
+            "details": quota,
+        }
 
         # skip default quota
         if len(quota["default"]) > 0:
@@ -126,7 +351,7 @@ for deleted in [False, True]:
         email = quota["users"][0]["user"]["email"]
         # store deleted info in quota
         quota['deleted'] = deleted
-        mail2quota[email] = quota
+        user_quotas[i] = (email, quota)
 
         if deleted:
             continue
@@ -142,6 +367,7 @@ for deleted in [False, True]:
         if datetime.now() > expires:
             logger.error(f"Quota {quota['name']} ({quota['display_amount']}) expired")
             gi.quotas.delete_quota(quota["id"])
+            new_snapshot["quotas"].pop(quota["id"])
             send_notification(
                 email,
                 "UFZ Galaxy: quota expiration",
@@ -153,66 +379,162 @@ for deleted in [False, True]:
                 "UFZ Galaxy: quota expiration",
                 f"Your additional Galaxy quota of {quota['display_amount']} will expire in {(expires - datetime.now()).days} days (on {quota['description']})."
             )
+
+    # fill the mapping in list order, i.e. if there are multiple quotas
+    # for a user the same one wins as for a sequential run
+    for user_quota in user_quotas:
+        if user_quota is None:
+            continue
+        email, quota = user_quota
+        mail2quota[email] = quota
+save_snapshot(args.snapshot, new_snapshot)
+
+# report disk usage of the users with an active quota, most utilized first
+if args.report:
+    holders = [email for email, quota in mail2quota.items() if not quota["deleted"]]
+    if not users_fetched and any(email not in mail2user for email in holders):
+        users = gi.users.get_users()
+        mail2user = {user["email"]: user for user in users}
+        new_snapshot["mail2user"] = mail2user
+        users_fetched = True
+    holders = [email for email in holders if email in mail2user]
+    rows = []
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = {
+            executor.submit(gi.users.show_user, mail2user[email]["id"]): email
+            for email in holders
+        }
+        for future in as_completed(futures):
+            email = futures[future]
+            try:
+                details = future.result()
+            except Exception as e:
+                logger.error(f"Could not get disk usage of {email}: {e}")
+                continue
+            quota = mail2quota[email]
+            rows.append(
+                {
+                    "email": email,
+                    "username": mail2user[email]["username"],
+                    "quota": quota["display_amount"],
+                    "quota_bytes": quota.get("bytes"),
+                    "expiration": quota["description"],
+                    "total_disk_usage": details.get("total_disk_usage"),
+                    "quota_percent": details.get("quota_percent"),
+                }
+            )
+    rows.sort(key=lambda r: r["quota_percent"] or 0, reverse=True)
+    write_table(args.report, {column: [row[column] for row in rows] for column in REPORT_COLUMNS})
+    logger.info(f"Wrote disk usage of {len(rows)} users to {args.report}")
+
 if not args.file or not os.path.exists(args.file):
     logger.debug(f"no such file: {args.file}")
     sys.exit(0)
 
+# parse and validate the complete file before anything is changed,
+# for repeated emails the last line wins
+updates = {}
+errors = []
 with open(args.file) as fh:
-    for line in fh:
+    for lineno, line in enumerate(fh, start=1):
         if line.startswith("#"):
             continue
-        line = line.strip()
-        if len(line) == 0:
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        if len(fields) != 3:
+            errors.append(f"line {lineno}: misformatted line {line.strip()}")
             continue
-        line = line.split()
-        if len(line) != 3:
-            sys.exit(f"misformatted line {line}")
+        email, amount, expiration = fields
 
+        if email not in mail2user and not users_fetched:
+            logger.debug(f"Unknown user {email} in snapshot, fetching users")
+            users = gi.users.get_users()
+            mail2user = {user["email"]: user for user in users}
+            new_snapshot["mail2user"] = mail2user
+            users_fetched = True
+        if email not in mail2user:
+            errors.append(f"line {lineno}: No such user: {email}")
+            continue
+        if not AMOUNT_RE.match(amount):
+            errors.append(f"line {lineno}: invalid amount {amount}")
+            continue
         try:
-            user = mail2user[line[0]]
-        except KeyError:
-            logger.error(f"No such user: {line[0]}")
-
-        amount = line[1]
-
-        date = datetime.strptime(line[2], "%d.%m.%Y")
-
-        # if there is already a quota for the user -> undelete and update it
-        # otherwise create it
-        if user["email"] in mail2quota:
-            logger.error(f"Updating quota {user['username']}")
-
-            if mail2quota[user["email"]]["deleted"]:
-                gi.quotas.undelete_quota(mail2quota[user["email"]]["id"])
-
-            gi.quotas.update_quota(
-                quota_id=mail2quota[user["email"]]["id"],
-                name=user["username"],
-                description=line[2],
-                default=None,
-                amount=amount,
-                operation="+",
-                in_users=[user["id"]],
-            )
-            send_notification(
-                user['email'],
-                "UFZ Galaxy: quota granted",
-                f"Your additional Galaxy quota of {amount} with expiration date {line[2]} has been updated."
-            )
-        else:
-            logger.debug(f"Creating quota {user['username']}")
-            gi.quotas.create_quota(
-                name=user["username"],
-                description=line[2],
-                amount=amount,
-                operation="+",
-                in_users=[user["id"]],
-            )
-            send_notification(
-                user['email'],
-                "UFZ Galaxy: quota granted",
-                f"Your additional Galaxy quota of {amount} with expiration date {line[2]} has been added."
-            )
+            datetime.strptime(expiration, "%d.%m.%Y")
+        except ValueError:
+            errors.append(f"line {lineno}: invalid expiration date {expiration}")
+            continue
+
+        if email in updates:
+            logger.warning(f"line {lineno}: {email} listed again, using this entry")
+        updates[email] = (amount, expiration, line)
+
+if errors:
+    for error in errors:
+        logger.error(error)
+    sys.exit(f"Found {len(errors)} errors in {args.file}, no quota was changed")
+
+# if there is already a quota for the user -> undelete and update it
+# (unless it is unchanged) otherwise create it
+plan = []
+unchanged = []
+for email, (amount, expiration, line) in updates.items():
+    quota = mail2quota.get(email)
+    if quota is not None and quota["id"] in from_snapshot and quota_unchanged(quota, amount, expiration):
+        # confirm with the current details, the snapshot may be outdated
+        details = gi.quotas.show_quota(quota["id"], deleted=quota["deleted"])
+        details["deleted"] = quota["deleted"]
+        quota = mail2quota[email] = details
+    if quota is None:
+        action = "create"
+    elif quota["deleted"]:
+        action = "undelete"
+    elif quota_unchanged(quota, amount, expiration):
+        logger.info(f"Plan: quota {mail2user[email]['username']} {amount} {expiration} unchanged")
+        unchanged.append(email)
+        continue
+    else:
+        action = "update"
+    plan.append(
+        {
+            "action": action,
+            "user": mail2user[email],
+            "quota_id": quota["id"] if quota else None,
+            "amount": amount,
+            "expiration": expiration,
+            "line": line,
+        }
+    )
+    logger.info(f"Plan: {action} quota {mail2user[email]['username']} {amount} {expiration}")
+
+if args.plan:
+    for update in plan:
+        print(f"{update['action']}\t{update['user']['email']}\t{update['amount']}\t{update['expiration']}")
+    for email in unchanged:
+        amount, expiration, _ = updates[email]
+        print(f"unchanged\t{email}\t{amount}\t{expiration}")
+    sys.exit(0)
+
+failed = []
+with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+    futures = {executor.submit(apply_quota_update, update): update for update in plan}
+    for done, future in enumerate(as_completed(futures), start=1):
+        update = futures[future]
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Could not {update['action']} quota {update['user']['username']}: {e}")
+            failed.append(update)
+        if update["quota_id"]:
+            new_snapshot["quotas"].pop(update["quota_id"], None)
+        logger.info(f"Applied {done}/{len(plan)} quota updates")
+
+save_snapshot(args.snapshot, new_snapshot)
 
+# keep the failed entries for the next run
 with open(args.file, "w") as fh:
     fh.write("#email\tamount\texpiration dd.mm.yyy\n")
+    for update in failed:
+        fh.write(f"{update['line'].rstrip()}\n")
+if failed:
+    sys.exit(f"{len(failed)}/{len(plan)} quota updates failed")
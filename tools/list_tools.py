@@ -8,6 +8,9 @@ import yaml
 from bioblend.galaxy import GalaxyInstance
 from bioblend.galaxy.tools import ToolClient
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from tool_filter import read_patterns, ToolFilter  # noqa: E402
+
 
 parser = argparse.ArgumentParser(description="Get all installed tools")
 parser.add_argument(
@@ -16,6 +19,34 @@ parser.add_argument(
 parser.add_argument(
     "--key", type=str, action="store", required=False, default=None, help="API key, better set API_KEY env var"
 )
+parser.add_argument(
+    "--include",
+    type=str,
+    action="append",
+    default=[],
+    help="include tool id by searching for regexp, if any filter applies a tool is included",
+)
+parser.add_argument(
+    "--exclude",
+    type=str,
+    action="append",
+    default=[],
+    help="filter tool id by searching for regexp, if any filter applies a tool is excluded",
+)
+parser.add_argument(
+    "--include-file",
+    type=str,
+    action="append",
+    default=[],
+    help="file with include regexps (one per line)",
+)
+parser.add_argument(
+    "--exclude-file",
+    type=str,
+    action="append",
+    default=[],
+    help="file with exclude regexps (one per line)",
+)
 parser.add_argument(
     "-log",
     "--loglevel",
@@ -41,11 +72,17 @@ key = os.environ.get('GALAXY_API_KEY', args.key)
 galaxy_instance = GalaxyInstance(url=args.url, key=key)
 tool_client = ToolClient(galaxy_instance)
 tools = tool_client.get_tools()
+tool_filter = ToolFilter(
+    args.include + [p for f in args.include_file for p in read_patterns(f)],
+    args.exclude + [p for f in args.exclude_file for p in read_patterns(f)],
+)
 
 tool_list = {}
 for i, tool in enumerate(tools):
     if not tool.get("tool_shed_repository"):
         continue
+    if not tool_filter(tool["id"]):
+        continue
     if not tool.get("panel_section_name"):
         if tool.get("model_class") == "DataManagerTool":
             tool["panel_section_name"] = "Data Managers"
@@ -2,13 +2,100 @@ import argparse
 import logging
 import os
 import os.path
+import sys
+from array import array
+from collections import deque
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from itertools import groupby
+from typing import List, Tuple
 
 from bioblend.galaxy import GalaxyInstance
 from bioblend.galaxy.users import UserClient
 from bioblend.galaxy.histories import HistoryClient
-from ldap3 import Connection, SUBTREE
+from ldap3 import Connection
+
+# optional, for vectorized aggregation
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from ldap_cache import sync_ldap_users  # noqa: E402
+from ldap_users import iter_ldap_users  # noqa: E402
+from tables import write_table  # noqa: E402
 
 USER_BATCH_SIZE = 10000
+# owner of datasets in histories of more than one user
+SHARED = -1
+
+
+def get_history_datasets(history_client: HistoryClient, history_id: str) -> List[Tuple[str, int]]:
+    """
+    get (dataset id, size) of the non purged datasets in a history
+
+    the dataset id is the id of the underlying dataset, i.e. it is the
+    same for copies of a dataset
+    """
+    contents = history_client.show_history(
+        history_id,
+        contents=True,
+        types=["dataset"],
+        keys=["dataset_id", "file_size", "purged"],
+    )
+    return [
+        (c["dataset_id"], c["file_size"] or 0) for c in contents if not c["purged"]
+    ]
+
+
+def group_sums(groups: array, values: array, n: int) -> Tuple[List[int], List[int]]:
+    """
+    sum and count values per group (groups are indices 0..n-1),
+    vectorized if numpy is installed
+    """
+    if numpy is not None and len(groups) > 0:
+        groups = numpy.frombuffer(groups, dtype=numpy.int64)
+        values = numpy.frombuffer(values, dtype=numpy.int64)
+        sums = numpy.zeros(n, dtype=numpy.int64)
+        numpy.add.at(sums, groups, values)
+        counts = numpy.bincount(groups, minlength=n)
+        return sums.tolist(), counts.tolist()
+    sums = [0] * n
+    counts = [0] * n
+    for group, value in zip(groups, values):
+        sums[group] += value
+        counts[group] += 1
+    return sums, counts
+
+
+def iter_history_pages(history_client: HistoryClient, workers: int):
+    """
+    yield the pages of all histories in offset order
+
+    up to workers pages are requested concurrently, iteration stops
+    at the first empty page
+    """
+    def get_page(offset):
+        return history_client.get_histories(
+            all=True, limit=USER_BATCH_SIZE, offset=offset, keys=["id", "user_id", "size"]
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        offset = 0
+        for _ in range(workers):
+            pending.append(executor.submit(get_page, offset))
+            offset += USER_BATCH_SIZE
+        while pending:
+            histories = pending.popleft().result()
+            if not histories:
+                break
+            yield histories
+            pending.append(executor.submit(get_page, offset))
+            offset += USER_BATCH_SIZE
+        for future in pending:
+            future.cancel()
+
 
 parser = argparse.ArgumentParser(
     description="Get histories of users that left the UFZ, i.e. are not in the LDAP anymore"
@@ -27,6 +114,13 @@ parser.add_argument(
     default=None,
     help="URL of the LDAP server",
 )
+parser.add_argument(
+    "--ldap-cache",
+    type=str,
+    action="store",
+    default=None,
+    help="SQLite file with a snapshot of the LDAP users, only changes are fetched if given",
+)
 parser.add_argument(
     "--outdir",
     type=str,
@@ -40,6 +134,26 @@ parser.add_argument(
     default=False,
     help="Process histories of all users, default only users not in LDAP",
 )
+parser.add_argument(
+    "--reclaimable",
+    action="store_true",
+    default=False,
+    help="list the datasets of the histories and report an upper bound of the space freed by purging "
+    "(copies counted once, references from other users' histories or libraries are ignored)",
+)
+parser.add_argument(
+    "--format",
+    choices=["csv", "parquet"],
+    default="csv",
+    help="format of the user and history tables written to outdir, parquet needs pandas, default=csv",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    action="store",
+    default=1,
+    help="number of history pages that are fetched in parallel, default=1",
+)
 parser.add_argument(
     "-log",
     "--loglevel",
@@ -66,11 +180,12 @@ key = os.environ.get('GALAXY_API_KEY', args.key)
 galaxy_instance = GalaxyInstance(url=args.url, key=key)
 
 ldap_conn = Connection(args.ldap_url, auto_bind=True)
-base_dn = "ou=people,dc=ufz,dc=de"
-ldap_conn.search(base_dn, "(objectClass=*)", SUBTREE, attributes=["uid", "cn", "mail"])
-ldap_uids = set()
-for entry in ldap_conn.entries:
-    ldap_uids.add(entry.uid.value)
+if args.ldap_cache:
+    ldap_uids = set(sync_ldap_users(ldap_conn, args.ldap_cache))
+else:
+    ldap_uids = set()
+    for entry in iter_ldap_users(ldap_conn, ["uid"]):
+        ldap_uids.add(entry["uid"])
 ldap_conn.unbind()
 logger.info(f"Found {len(ldap_uids)} users in LDAP")
 
@@ -78,7 +193,6 @@ user_client = UserClient(galaxy_instance=galaxy_instance)
 users = user_client.get_users()
 
 user_by_id = {}
-histories_by_user_id = {}
 for user in users:
     uid = user["id"]
     username = user.get("username")
@@ -90,55 +204,104 @@ for user in users:
     logger.info(f"Consider {username} {email} {uid}")
 
     user_by_id[uid] = user
-    histories_by_user_id[uid] = []
 logger.info(f"Total {len(user_by_id)}/{len(users)} Galaxy users to delete")
 
-size_left = 0
-n_left = 0
+# columns of the histories of the considered users,
+# the user is stored as index into user_ids
+user_ids = list(user_by_id)
+user_index = {uid: i for i, uid in enumerate(user_ids)}
+history_user = array("q")
+history_size = array("q")
+history_ids = []
+
 size_present = 0
 n_present = 0
 
 history_client = HistoryClient(galaxy_instance)
-offset = 1
-while True:
-    histories = history_client.get_histories(
-        all=True, limit=USER_BATCH_SIZE, offset=offset, keys=["id", "user_id", "size"]
-    )
-    if not histories:
-        break
-    offset += USER_BATCH_SIZE
-
+for histories in iter_history_pages(history_client, args.workers):
     for history in histories:
-        user_id = history["user_id"]
-        size = history["size"]
-        if user_id not in user_by_id:
-            size_present += size
+        index = user_index.get(history["user_id"])
+        if index is None:
+            size_present += history["size"]
             n_present += 1
             continue
-        size_left += size
-        n_left += 1
-        histories_by_user_id[user_id].append(history)
+        history_user.append(index)
+        history_size.append(int(history["size"]))
+        history_ids.append(history["id"])
+
+user_size, user_count = group_sums(history_user, history_size, len(user_ids))
 
-if n_left:
+if history_ids:
     print(
-        f"considered users: {round(size_left / (1024 ** 3))} GB in {n_left} histories"
+        f"considered users: {round(sum(user_size) / (1024 ** 3))} GB in {len(history_ids)} histories"
     )
 if n_present:
     print(
         f"ignored users: {round(size_present / (1024 ** 3))} GB in {n_present} histories"
     )
 
-for user_id in user_by_id:
-    username = user_by_id[user_id]["username"]
+# history lists, grouped by user
+order = sorted(range(len(history_ids)), key=history_user.__getitem__)
+for index, group in groupby(order, key=history_user.__getitem__):
+    username = user_by_id[user_ids[index]]["username"]
     with open(os.path.join(args.outdir, f"{username}.histories"), "a") as hf:
-        for history_details in histories_by_user_id[user_id]:
-            hf.write(f"{history_details['id']}\n")
-
-for user_id in user_by_id:
-    user_by_id[user_id]["size"] = 0
-    for history_details in histories_by_user_id[user_id]:
-        user_by_id[user_id]["size"] += history_details["size"]
-for uid, user in sorted(user_by_id.items(), key=lambda d: d[1]["size"]):
+        for row in group:
+            hf.write(f"{history_ids[row]}\n")
+
+user_table = {
+    "user_id": user_ids,
+    "username": [user_by_id[uid]["username"] for uid in user_ids],
+    "email": [user_by_id[uid]["email"] for uid in user_ids],
+    "histories": user_count,
+    "size": user_size,
+}
+
+# storage that is freed by purging, i.e. each dataset is counted once
+# (also if it is contained in several histories). datasets contained in
+# histories of more than one considered user are counted as shared.
+# references from histories of other users and from libraries are not
+# checked, so this is an upper bound
+if args.reclaimable:
+    dataset_size = {}
+    dataset_owner = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(get_history_datasets, history_client, history_id): index
+            for history_id, index in zip(history_ids, history_user)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            for dataset_id, size in future.result():
+                dataset_size[dataset_id] = size
+                if dataset_owner.setdefault(dataset_id, index) != index:
+                    dataset_owner[dataset_id] = SHARED
+    user_reclaimable = [0] * len(user_ids)
+    shared = 0
+    for dataset_id, owner in dataset_owner.items():
+        if owner == SHARED:
+            shared += dataset_size[dataset_id]
+        else:
+            user_reclaimable[owner] += dataset_size[dataset_id]
+    user_table["reclaimable_upper_bound"] = user_reclaimable
+    print(
+        f"reclaimable (upper bound, ignores references outside the selected users): {round(sum(dataset_size.values()) / (1024 ** 3))} GB in {len(dataset_size)} datasets"
+        f" ({round(shared / (1024 ** 3))} GB shared between considered users)"
+    )
+
+write_table(os.path.join(args.outdir, f"users.{args.format}"), user_table)
+write_table(
+    os.path.join(args.outdir, f"histories.{args.format}"),
+    {
+        "user_id": [user_ids[index] for index in history_user],
+        "history_id": history_ids,
+        "size": history_size,
+    },
+)
+
+for index in sorted(range(len(user_ids)), key=user_size.__getitem__):
+    reclaimable = ""
+    if args.reclaimable:
+        reclaimable = f" ({user_reclaimable[index] / (1024**3)} GB reclaimable at most)"
     print(
-        f"{user['username']} {len(histories_by_user_id[uid])} histories {user['size'] / (1024**3)} GB"
+        f"{user_by_id[user_ids[index]]['username']} {user_count[index]} histories {user_size[index] / (1024**3)} GB{reclaimable}"
     )
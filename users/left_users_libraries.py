@@ -2,6 +2,7 @@ import argparse
 import logging
 import os
 import os.path
+from concurrent.futures import as_completed, ThreadPoolExecutor
 
 from bioblend.galaxy import GalaxyInstance
 
@@ -33,6 +34,13 @@ parser.add_argument(
     default=False,
     help="Really delete",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    action="store",
+    default=1,
+    help="number of folders that are processed in parallel, default=1",
+)
 parser.add_argument(
     "-log",
     "--loglevel",
@@ -67,44 +75,82 @@ root_folder = gi.libraries.show_folder(
 )
 
 
+def folder_size(folder_id):
+    """
+    total size of the non deleted datasets in the folder and its subfolders
+    """
+    size = 0
+    stack = [folder_id]
+    while stack:
+        for content in gi.folders.contents_iter(folder_id=stack.pop(), batch_size=1000):
+            if content["type"] == "folder":
+                stack.append(content["id"])
+            elif content["type"] == "file":
+                size += content.get("raw_size") or 0
+    return size
+
+
+def process_folder(folder):
+    """
+    determine the size of a user library folder and delete it
+    """
+    size = folder_size(folder["id"])
+    if args.delete:
+        gi.folders.delete_folder(folder["id"])
+    return size
+
+
 def process(user_data_library, folder):
+    """
+    list the contents of the folder and process the user library folders
+    (of users that left) on a pool of workers
+
+    the complete listing is fetched before any folder is deleted, since
+    contents_iter pages by offset and deletions would shift the pages
+    """
     cnt = 0
-    folder_id = folder["id"]
-    item_count = gi.folders.show_folder(folder_id=folder_id)["item_count"]
-    folder_details = gi.folders.show_folder(
-        folder_id=folder_id, contents=True, limit=item_count
-    )
-
-    metadata = folder_details["metadata"]
-    full_path = [c[1] for c in metadata["full_path"]]
-    full_path_str = "/".join(full_path)
-    for content in folder_details["folder_contents"]:
-        if content["type"] == "folder":
-            if len(full_path) == 1:
-                if not args.all_users and content["name"] in usernames:
-                    logger.debug(f"Skip {content['name']}")
-                    continue
-                else:
-                    logger.info(f"Consider {content['name']}")
+    total_size = 0
+    full_path_str = folder["name"]
+    candidates = []
+    for content in gi.folders.contents_iter(folder_id=folder["id"], batch_size=1000):
+        if content["type"] != "folder":
+            logger.error(
+                f"Unknown content type: {content['type']} in {full_path_str} {content=}"
+            )
+            continue
+        if not args.all_users and content["name"] in usernames:
+            logger.debug(f"Skip {content['name']}")
+            continue
+        logger.info(f"Consider {content['name']}")
+        candidates.append(content)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_folder, content): content for content in candidates}
+
+        for future in as_completed(futures):
+            content = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                logger.error(f"Could not process folder '{content['name']}': {e}")
+                continue
             cnt += 1
+            total_size += size
             if args.delete:
-                gi.folders.delete_folder(content["id"])
-                logger.warning(f"Deleted folder '{content['name']}' in {full_path_str}")
+                logger.warning(
+                    f"Deleted folder '{content['name']}' ({size} bytes) in {full_path_str}"
+                )
             else:
                 logger.warning(
-                    f"Could delete folder '{content['name']}' in {full_path_str}"
+                    f"Could delete folder '{content['name']}' ({size} bytes) in {full_path_str}"
                 )
-        else:
-            logger.error(
-                f"Unknown content type: {content['type']} in {full_path=} {metadata=}"
-            )
-    return cnt
+    return cnt, total_size
 
 
-cnt = process(user_data_library, root_folder)
+cnt, total_size = process(user_data_library, root_folder)
 
 if cnt > 0:
     if args.delete:
-        logger.warning(f"Deleted {cnt} user library folders")
+        logger.warning(f"Deleted {cnt} user library folders ({total_size} bytes)")
     else:
-        logger.warning(f"Could delete {cnt} user library folders")
+        logger.warning(f"Could delete {cnt} user library folders ({total_size} bytes)")
@@ -0,0 +1,152 @@
+"""
+Delete (and purge) the histories listed in .histories files
+
+the files are written by left_users_histories.py (one history id per line).
+histories are deleted by a pool of workers with an optional rate limit,
+completed ids are recorded in a checkpoint file (together with the
+operation, deleted or purged) such that an interrupted run continues where
+it stopped. a purge run also processes histories that a previous run only
+deleted
+"""
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import as_completed, ThreadPoolExecutor
+
+from bioblend.galaxy import GalaxyInstance
+from bioblend.galaxy.histories import HistoryClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from resumable import Checkpoint, RateLimiter  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Delete histories listed in .histories files"
+)
+parser.add_argument(
+    "--url", type=str, action="store", required=True, default=None, help="Galaxy URL"
+)
+parser.add_argument(
+    "--key", type=str, action="store", required=False, default=None, help="API key, better set API_KEY env var"
+)
+parser.add_argument(
+    "histories",
+    type=str,
+    nargs="+",
+    help=".histories files",
+)
+parser.add_argument(
+    "--delete",
+    action="store_true",
+    default=False,
+    help="Really delete",
+)
+parser.add_argument(
+    "--purge",
+    action="store_true",
+    default=False,
+    help="Purge the deleted histories",
+)
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    action="store",
+    default="purge_histories.checkpoint",
+    help="file recording the processed history ids, default=purge_histories.checkpoint",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    action="store",
+    default=1,
+    help="number of parallel requests, default=1",
+)
+parser.add_argument(
+    "--rate",
+    type=float,
+    action="store",
+    default=None,
+    help="maximum number of requests per second, default: unlimited",
+)
+parser.add_argument(
+    "-log",
+    "--loglevel",
+    choices=["debug", "info", "warning", "error"],
+    default="warning",
+    help="Provide logging level. Example --loglevel debug, default=warning",
+)
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+# Set the log level for your logger to the desired level (e.g., INFO)
+logger.setLevel(args.loglevel.upper())
+
+# Create a handler for logging output (e.g., console handler)
+handler = logging.StreamHandler()
+logger.addHandler(handler)
+
+# Add a formatter to the handler (optional)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+
+key = os.environ.get('GALAXY_API_KEY', args.key)
+galaxy_instance = GalaxyInstance(url=args.url, key=key)
+history_client = HistoryClient(galaxy_instance)
+
+history_ids = []
+for path in args.histories:
+    with open(path) as fh:
+        history_ids.extend(line.strip() for line in fh if line.strip())
+
+# a purged history is also deleted, i.e. a delete run skips both
+operation = "purged" if args.purge else "deleted"
+covered = {"purged"} if args.purge else {"deleted", "purged"}
+# dry runs also skip the recorded histories, but do not write the checkpoint
+checkpoint = Checkpoint(args.checkpoint, readonly=not args.delete)
+todo = [
+    h for h in dict.fromkeys(history_ids)
+    if h not in checkpoint or (checkpoint.state(h) or "deleted") not in covered
+]
+logger.info(f"{len(todo)}/{len(history_ids)} histories to process")
+if not args.delete:
+    for history_id in todo:
+        print(f"Could delete history {history_id}")
+    sys.exit(0)
+
+rate_limiter = RateLimiter(args.rate)
+
+
+def delete_history(history_id: str):
+    """
+    delete the history and record it in the checkpoint
+    """
+    rate_limiter.wait()
+    history_client.delete_history(history_id, purge=args.purge)
+    checkpoint.add(history_id, operation)
+
+
+failed = 0
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    futures = {executor.submit(delete_history, h): h for h in todo}
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            history_id = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Could not delete history {history_id}: {e}")
+                failed += 1
+                continue
+            logger.info(f"Deleted history {history_id} ({done}/{len(todo)})")
+    except KeyboardInterrupt:
+        # running deletions finish (and are checkpointed), queued ones are dropped
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        checkpoint.close()
+
+if failed:
+    sys.exit(f"Could not delete {failed}/{len(todo)} histories")